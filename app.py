@@ -1,9 +1,21 @@
-import json
 import os
 import streamlit as st
 from datetime import datetime
-import pandas as pd
+import atexit
 import hashlib
+import hmac
+import logging
+import secrets
+import time
+import bcrypt
+import numpy as np
+import orjson
+import pyarrow.parquet as pq
+from collections import OrderedDict, defaultdict
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
 
 # ---------------- CONFIG ----------------
 st.set_page_config(
@@ -13,129 +25,394 @@ st.set_page_config(
 )
 
 # ---------------- USER AUTHENTICATION ----------------
+PASSWORD_CACHE_SIZE = 1024
+# Fixed bcrypt hash (same cost as gensalt()'s default) checked for unknown
+# usernames, so they take as long to reject as a wrong password
+DUMMY_PASSWORD_HASH = b"$2b$12$d6EeYe91Nn6m/2cZzKA.v.sCDAWfh35DKH7rgwa.2Vktv93ojifVG"
+
 def hash_password(password):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+def legacy_hash_password(password):
+    # Unsalted SHA-256 used by accounts created before the move to bcrypt
     return hashlib.sha256(password.encode()).hexdigest()
 
-def load_users():
+@st.cache_resource
+def get_password_cache():
+    # LRU of successfully verified (username, stored hash, SHA-256 of input) -> True.
+    # Only the digest of the submitted password is kept, never the plaintext.
+    return {"entries": OrderedDict(), "lock": threading.Lock()}
+
+def verify_password(username, password, stored_hash):
+    cache = get_password_cache()
+    submitted_digest = legacy_hash_password(password)
+    key = (username, stored_hash, submitted_digest)
+    with cache["lock"]:
+        if key in cache["entries"]:
+            cache["entries"].move_to_end(key)
+            return cache["entries"][key]
+    
+    if stored_hash.startswith("$2"):
+        result = bcrypt.checkpw(password.encode(), stored_hash.encode())
+    else:
+        result = hmac.compare_digest(stored_hash, submitted_digest)
+        if not result:
+            # Match the bcrypt cost of other rejections so legacy accounts can't be told apart
+            bcrypt.checkpw(password.encode(), DUMMY_PASSWORD_HASH)
+    
+    # Only successes are cached: a fast repeat rejection would reveal that the user exists
+    if result:
+        with cache["lock"]:
+            cache["entries"][key] = result
+            if len(cache["entries"]) > PASSWORD_CACHE_SIZE:
+                cache["entries"].popitem(last=False)
+    return result
+
+USERS_DB = "users.db"
+LEGACY_USERS_FILE = "users.json"
+
+@st.cache_resource
+def get_user_db():
+    # One connection shared by all sessions; the lock serializes access to it
+    conn = sqlite3.connect(USERS_DB, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS users ("
+        "username TEXT PRIMARY KEY, "
+        "password_hash TEXT NOT NULL, "
+        "created_at TEXT, "
+        "progress TEXT)"
+    )
+    conn.commit()
+    migrate_legacy_users(conn)
+    return {"conn": conn, "lock": threading.Lock()}
+
+def dump_progress(progress):
+    # orjson emits UTF-8 bytes; decode so the progress column stays TEXT
+    return orjson.dumps(progress).decode()
+
+def migrate_legacy_users(conn):
+    # First run only: copy accounts from the old users.json store
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        return
+    if not os.path.exists(LEGACY_USERS_FILE):
+        return
     try:
-        if os.path.exists("users.json"):
-            with open("users.json", "r") as f:
-                return json.load(f)
+        with open(LEGACY_USERS_FILE, "rb") as f:
+            users = orjson.loads(f.read())
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (username, password_hash, created_at, progress) VALUES (?, ?, ?, ?)",
+                [
+                    (username, user["password_hash"], user.get("created_at"), dump_progress(user.get("progress", {})))
+                    for username, user in users.items()
+                ]
+            )
     except Exception as e:
-        st.error(f"Error loading users: {e}")
-    return {}
+        st.error(f"Error migrating users: {e}")
 
-def save_users(users):
+def get_user(username):
+    db = get_user_db()
     try:
-        with open("users.json", "w") as f:
-            json.dump(users, f)
-        return True
+        with db["lock"]:
+            row = db["conn"].execute(
+                "SELECT password_hash, created_at, progress FROM users WHERE username = ?",
+                (username,)
+            ).fetchone()
     except Exception as e:
-        st.error(f"Error saving users: {e}")
-        return False
+        st.error(f"Error loading user: {e}")
+        return None
+    if row is None:
+        return None
+    return {
+        "password_hash": row[0],
+        "created_at": row[1],
+        "progress": orjson.loads(row[2]) if row[2] else {}
+    }
 
 def create_user(username, password):
-    users = load_users()
-    if username in users:
+    if get_user(username) is not None:
         return False, "Username already exists"
-    users[username] = {
-        "password_hash": hash_password(password),
-        "created_at": datetime.now().isoformat(),
-        "progress": {
-            "questions_attempted": [],
-            "correct_questions": [],
-            "incorrect_questions": [],
-            "marked_questions": [],
-            "performance_by_system": {},
-            "performance_by_subject": {}
-        }
+    progress = {
+        "questions_attempted": [],
+        "correct_questions": [],
+        "incorrect_questions": [],
+        "marked_questions": [],
+        "performance_by_system": {},
+        "performance_by_subject": {}
     }
-    if save_users(users):
-        return True, "User created successfully"
-    return False, "Error creating user"
-
-def authenticate_user(username, password):
-    users = load_users()
-    if username not in users:
-        return False, "User not found"
-    if users[username]["password_hash"] == hash_password(password):
-        return True, "Login successful"
-    return False, "Invalid password"
+    db = get_user_db()
+    try:
+        with db["lock"], db["conn"]:
+            db["conn"].execute(
+                "INSERT INTO users (username, password_hash, created_at, progress) VALUES (?, ?, ?, ?)",
+                (username, hash_password(password), datetime.now().isoformat(), dump_progress(progress))
+            )
+    except sqlite3.IntegrityError:
+        return False, "Username already exists"
+    except Exception as e:
+        st.error(f"Error saving user: {e}")
+        return False, "Error creating user"
+    return True, "User created successfully"
 
-def save_user_progress(username):
+def upgrade_password_hash(username, password):
+    # Re-hash a verified legacy SHA-256 password with bcrypt
+    db = get_user_db()
     try:
-        users = load_users()
-        if username in users:
-            progress = st.session_state.user_progress
-            # Convert sets to lists for JSON
-            users[username]["progress"] = {
-                "questions_attempted": list(progress["questions_attempted"]),
-                "correct_questions": list(progress["correct_questions"]),
-                "incorrect_questions": list(progress["incorrect_questions"]),
-                "marked_questions": list(progress["marked_questions"]),
-                "performance_by_system": progress["performance_by_system"],
-                "performance_by_subject": progress["performance_by_subject"],
-                "last_saved": datetime.now().isoformat()
-            }
-            save_users(users)
+        with db["lock"], db["conn"]:
+            db["conn"].execute(
+                "UPDATE users SET password_hash = ? WHERE username = ?",
+                (hash_password(password), username)
+            )
+    except Exception as e:
+        st.error(f"Error upgrading password hash: {e}")
+
+def authenticate_user(username, password, user=None):
+    if user is None:
+        user = get_user(username)
+    # Same message for unknown users and wrong passwords, so logins can't probe usernames
+    if user is None:
+        bcrypt.checkpw(password.encode(), DUMMY_PASSWORD_HASH)
+        return False, "Invalid username or password"
+    if verify_password(username, password, user["password_hash"]):
+        if not user["password_hash"].startswith("$2"):
+            upgrade_password_hash(username, password)
+        return True, "Login successful"
+    return False, "Invalid username or password"
+
+# ---------------- SESSION TOKENS ----------------
+SESSION_TTL_SECONDS = 12 * 60 * 60
+
+@st.cache_resource
+def get_session_secret():
+    # Set SESSION_SECRET to keep sessions valid across server restarts
+    secret = os.environ.get("SESSION_SECRET")
+    return secret.encode() if secret else secrets.token_bytes(32)
+
+def sign_session(username, exp):
+    return hmac.new(get_session_secret(), f"{username}|{exp}".encode(), "sha256").hexdigest()
+
+def issue_session_token(username):
+    exp = int(time.time()) + SESSION_TTL_SECONDS
+    st.session_state.session_token = (username, exp, sign_session(username, exp))
+
+def verify_session_token():
+    token = st.session_state.get("session_token")
+    if not token:
+        return False
+    username, exp, signature = token
+    if username != st.session_state.username or exp < time.time():
+        return False
+    return hmac.compare_digest(signature, sign_session(username, exp))
+
+# ---------------- PROGRESS PERSISTENCE ----------------
+PROGRESS_FLUSH_SECONDS = 30
+
+@st.cache_resource
+def get_progress_writer():
+    # Progress snapshots waiting to be written, shared by all sessions
+    writer = {"pending": {}, "timer": None, "lock": threading.Lock(), "flush_lock": threading.Lock()}
+    atexit.register(flush_pending_progress, writer)
+    return writer
+
+def schedule_progress_flush(writer):
+    # Caller must hold writer["lock"]
+    if writer["timer"] is None:
+        writer["timer"] = threading.Timer(PROGRESS_FLUSH_SECONDS, flush_pending_progress, args=(writer,))
+        writer["timer"].daemon = True
+        writer["timer"].start()
+
+def flush_pending_progress(writer):
+    # One flush at a time from taking the snapshots through the commit, so an
+    # older snapshot can never be written over a newer one
+    with writer["flush_lock"]:
+        with writer["lock"]:
+            pending = writer["pending"]
+            writer["pending"] = {}
+            writer["timer"] = None
+        if not pending:
+            return True
+        
+        try:
+            db = get_user_db()
+            # Only the rows of users with unsaved progress are rewritten
+            with db["lock"], db["conn"]:
+                db["conn"].executemany(
+                    "UPDATE users SET progress = ? WHERE username = ?",
+                    [(dump_progress(progress), username) for username, progress in pending.items()]
+                )
             return True
+        except Exception:
+            # Usually runs on the timer thread, where st.error would be dropped
+            logger.exception("Error saving progress")
+        
+        # Re-queue anything that wasn't superseded by a newer snapshot and retry later
+        with writer["lock"]:
+            for username, progress in pending.items():
+                writer["pending"].setdefault(username, progress)
+            schedule_progress_flush(writer)
+        return False
+
+def save_user_progress(username, immediate=False):
+    if not verify_session_token():
+        st.error("Session expired. Please login again.")
+        return False
+    return queue_user_progress(username, immediate)
+
+def queue_user_progress(username, immediate=False):
+    # No token check: also used to keep an expired session's unsaved answers
+    if not st.session_state.get("progress_dirty"):
+        return True
+    try:
+        progress = st.session_state.user_progress
+        # Convert sets to lists for JSON; copy stats so later answers don't race the writer
+        snapshot = {
+            "questions_attempted": list(progress["questions_attempted"]),
+            "correct_questions": list(progress["correct_questions"]),
+            "incorrect_questions": list(progress["incorrect_questions"]),
+            "marked_questions": list(progress["marked_questions"]),
+            "performance_by_system": {k: dict(v) for k, v in progress["performance_by_system"].items()},
+            "performance_by_subject": {k: dict(v) for k, v in progress["performance_by_subject"].items()},
+            "last_saved": datetime.now().isoformat()
+        }
+        writer = get_progress_writer()
+        with writer["lock"]:
+            writer["pending"][username] = snapshot
+            if not immediate:
+                schedule_progress_flush(writer)
+        st.session_state.progress_dirty = False
+        
+        if immediate:
+            return flush_pending_progress(writer)
+        return True
     except Exception as e:
         st.error(f"Error saving progress: {e}")
     return False
 
-def load_user_progress(username):
-    users = load_users()
-    if username in users:
-        progress = users[username].get("progress", {})
+def performance_counter(stats=None):
+    # Missing systems/subjects start at zero, so answers can update in place
+    return defaultdict(lambda: {"correct": 0, "total": 0}, stats or {})
+
+def load_user_progress(username, user=None):
+    if user is None:
+        user = get_user(username)
+    if user is not None:
+        progress = user["progress"]
         # Convert lists back to sets
         return {
             "questions_attempted": set(progress.get("questions_attempted", [])),
             "correct_questions": set(progress.get("correct_questions", [])),
             "incorrect_questions": set(progress.get("incorrect_questions", [])),
             "marked_questions": set(progress.get("marked_questions", [])),
-            "performance_by_system": progress.get("performance_by_system", {}),
-            "performance_by_subject": progress.get("performance_by_subject", {})
+            "performance_by_system": performance_counter(progress.get("performance_by_system")),
+            "performance_by_subject": performance_counter(progress.get("performance_by_subject"))
         }
     return {
         "questions_attempted": set(),
         "correct_questions": set(),
         "incorrect_questions": set(),
         "marked_questions": set(),
-        "performance_by_system": {},
-        "performance_by_subject": {}
+        "performance_by_system": performance_counter(),
+        "performance_by_subject": performance_counter()
     }
 
 # ---------------- LOAD QUESTIONS ----------------
-@st.cache_data
+@st.cache_resource
 def load_questions():
+    # cache_resource hands every session the same object without hashing or
+    # copying it. The tuple stops the bank being reordered or resized, but the
+    # question dicts inside are shared too and must never be modified.
     try:
         json_path = "questions.json"
+        parquet_path = "questions.parquet"
+        
+        # Prefer the Parquet copy from convert_questions.py unless questions.json is newer
+        if os.path.exists(parquet_path) and (
+            not os.path.exists(json_path) or os.path.getmtime(parquet_path) >= os.path.getmtime(json_path)
+        ):
+            table = pq.read_table(parquet_path, memory_map=True)
+            # Parquet stores absent fields as nulls; drop them so q.get() defaults still apply
+            return tuple({k: v for k, v in row.items() if v is not None} for row in table.to_pylist())
+        
         if not os.path.exists(json_path):
             st.error("❌ questions.json not found")
-            return []
+            return ()
         
-        with open(json_path, "r", encoding="utf-8") as f:
-            questions = json.load(f)
+        with open(json_path, "rb") as f:
+            questions = orjson.loads(f.read())
         
-        return questions
+        return tuple(questions)
     except Exception as e:
         st.error(f"Error loading questions: {e}")
-        return []
+        return ()
+
+@st.cache_resource
+def build_question_index(_questions):
+    # Question positions grouped by system/subject, built once per process
+    id_to_idx = {}
+    by_system = {}
+    by_subject = {}
+    for i, q in enumerate(_questions):
+        id_to_idx[q["id"]] = i
+        by_system.setdefault(q.get("system", "General"), []).append(i)
+        by_subject.setdefault(q.get("subject", "General"), []).append(i)
+    return {
+        "id_to_idx": id_to_idx,
+        # Position arrays, so a selection mask costs O(selected questions)
+        "by_system": {name: np.array(idx) for name, idx in by_system.items()},
+        "by_subject": {name: np.array(idx) for name, idx in by_subject.items()}
+    }
+
+@st.cache_resource
+def get_filter_options(_questions):
+    # Sorted multiselect choices; the bank never changes at runtime, so this runs once per process
+    index = build_question_index(_questions)
+    return tuple(sorted(index["by_system"])), tuple(sorted(index["by_subject"]))
 
 questions = load_questions()
+question_index = build_question_index(questions)
+
+def build_candidate_pools(progress):
+    # One boolean array per question filter, aligned with the question bank.
+    # Built at login and kept current as answers come in, so starting a quiz
+    # only has to combine masks.
+    id_to_idx = question_index["id_to_idx"]
+    
+    def positions(ids):
+        return [id_to_idx[q_id] for q_id in ids if q_id in id_to_idx]
+    
+    pools = {
+        "all": np.ones(len(questions), dtype=bool),
+        "unused": np.ones(len(questions), dtype=bool),
+        "marked": np.zeros(len(questions), dtype=bool),
+        "incorrect": np.zeros(len(questions), dtype=bool)
+    }
+    pools["unused"][positions(progress["questions_attempted"])] = False
+    pools["marked"][positions(progress["marked_questions"])] = True
+    pools["incorrect"][positions(progress["incorrect_questions"])] = True
+    return pools
+
+def selection_mask(groups, selected):
+    # Flag every question in the selected systems/subjects
+    mask = np.zeros(len(questions), dtype=bool)
+    for name in set(selected):
+        mask[groups[name]] = True
+    return mask
 
 # ---------------- SESSION STATE ----------------
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
     st.session_state.username = None
+    st.session_state.session_token = None
+    st.session_state.progress_dirty = False
     st.session_state.user_progress = {
         "questions_attempted": set(),
         "correct_questions": set(),
         "incorrect_questions": set(),
         "marked_questions": set(),
-        "performance_by_system": {},
-        "performance_by_subject": {}
+        "performance_by_system": performance_counter(),
+        "performance_by_subject": performance_counter()
     }
+    st.session_state.candidate_pools = build_candidate_pools(st.session_state.user_progress)
 
 if "quiz_config" not in st.session_state:
     st.session_state.quiz_config = {
@@ -153,7 +430,7 @@ if "quiz_state" not in st.session_state:
         "score": 0,
         "answered": False,
         "selected": None,
-        "marked": set(),
+        "marked_mask": np.zeros(0, dtype=bool),
         "quiz_start_time": None
     }
 
@@ -193,8 +470,9 @@ def show_home():
     max_q = min(50, len(questions))  # Reduced max for better performance
     num_q = st.slider("Number of questions", 5, max_q, 10, 5)
     
+    all_systems, all_subjects = get_filter_options(questions)
+    
     # Filter by system
-    all_systems = sorted(set([q.get("system", "General") for q in questions]))
     selected_systems = st.multiselect(
         "Select systems:",
         all_systems,
@@ -202,7 +480,6 @@ def show_home():
     )
     
     # Filter by subject
-    all_subjects = sorted(set([q.get("subject", "General") for q in questions]))
     selected_subjects = st.multiselect(
         "Select subjects:",
         all_subjects,
@@ -227,36 +504,20 @@ def show_home():
     
     # Start Quiz Button
     if st.button("🚀 Start Quiz", type="primary", use_container_width=True):
-        # Filter questions based on selection
-        filtered_questions = questions.copy()
-        
-        # Filter by system
+        # Start from the prebuilt pool for the question filter, then narrow by system/subject
+        mask = st.session_state.candidate_pools[filter_map[filter_option]].copy()
         if selected_systems:
-            filtered_questions = [q for q in filtered_questions if q.get("system", "General") in selected_systems]
-        
-        # Filter by subject
+            mask &= selection_mask(question_index["by_system"], selected_systems)
         if selected_subjects:
-            filtered_questions = [q for q in filtered_questions if q.get("subject", "General") in selected_subjects]
+            mask &= selection_mask(question_index["by_subject"], selected_subjects)
         
-        # Apply question filter
-        user_progress = st.session_state.user_progress
-        if filter_map[filter_option] == "marked":
-            marked_ids = user_progress["marked_questions"]
-            filtered_questions = [q for q in filtered_questions if q["id"] in marked_ids]
-        elif filter_map[filter_option] == "incorrect":
-            incorrect_ids = user_progress["incorrect_questions"]
-            filtered_questions = [q for q in filtered_questions if q["id"] in incorrect_ids]
-        elif filter_map[filter_option] == "unused":
-            attempted_ids = user_progress["questions_attempted"]
-            filtered_questions = [q for q in filtered_questions if q["id"] not in attempted_ids]
-        
-        # Limit number of questions
-        import random
-        if len(filtered_questions) > num_q:
-            filtered_questions = random.sample(filtered_questions, num_q)
-        elif len(filtered_questions) < 1:
+        # Limit number of questions, sampling positions rather than question dicts
+        candidate_idx = np.flatnonzero(mask)
+        if candidate_idx.size < 1:
             st.error("❌ No questions match your criteria. Try different filters.")
             return
+        chosen = np.random.default_rng().choice(candidate_idx, size=min(num_q, candidate_idx.size), replace=False)
+        filtered_questions = [questions[i] for i in chosen]
         
         # Save quiz configuration
         st.session_state.quiz_config = {
@@ -274,7 +535,8 @@ def show_home():
             "score": 0,
             "answered": False,
             "selected": None,
-            "marked": set(),
+            # Marks are per quiz position, so a fixed-size mask is enough
+            "marked_mask": np.zeros(len(filtered_questions), dtype=bool),
             "quiz_start_time": datetime.now()
         }
         
@@ -304,7 +566,7 @@ def show_quiz():
     col1, col2, col3 = st.columns([2, 3, 2])
     with col1:
         if st.button("🏠 Home"):
-            if save_user_progress(st.session_state.username):
+            if save_user_progress(st.session_state.username, immediate=True):
                 st.success("Progress saved!")
             st.session_state.quiz_config["quiz_started"] = False
             st.rerun()
@@ -312,12 +574,9 @@ def show_quiz():
         st.markdown(f"### Question {quiz_state['idx'] + 1} of {len(quiz_questions)}")
     with col3:
         # Mark for review button
-        mark_label = "✅ Unmark" if q_id in quiz_state["marked"] else "📌 Mark for Review"
+        mark_label = "✅ Unmark" if quiz_state["marked_mask"][quiz_state["idx"]] else "📌 Mark for Review"
         if st.button(mark_label):
-            if q_id in quiz_state["marked"]:
-                quiz_state["marked"].remove(q_id)
-            else:
-                quiz_state["marked"].add(q_id)
+            quiz_state["marked_mask"][quiz_state["idx"]] ^= True
             st.rerun()
     
     st.progress((quiz_state["idx"]) / len(quiz_questions))
@@ -337,25 +596,38 @@ def show_quiz():
     options = q.get("options", [])
     correct_answer = q.get("answer", "A")
     
-    # Display options
-    selected_option = None
-    for i, opt in enumerate(options):
-        letter = chr(65 + i)
-        label = f"{letter}. {opt}"
-        
-        if st.button(
-            label,
-            key=f"opt_{i}_{quiz_state['idx']}",  # Added idx to key for uniqueness
+    # Display options in a form so picking one doesn't rerun the script;
+    # only submitting the answer does
+    labels = [f"{chr(65 + i)}. {opt}" for i, opt in enumerate(options)]
+    with st.form(f"q_form_{quiz_state['idx']}"):
+        choice = st.radio(
+            "Options",
+            labels,
+            index=ord(quiz_state["selected"]) - 65 if quiz_state["answered"] else None,
+            key=f"opt_{quiz_state['idx']}",
+            disabled=quiz_state["answered"],
+            label_visibility="collapsed"
+        )
+        submitted = st.form_submit_button(
+            "Submit Answer",
             disabled=quiz_state["answered"],
             use_container_width=True
-        ):
+        )
+    
+    if submitted and not quiz_state["answered"]:
+        if choice is None:
+            st.warning("Please select an answer first")
+        else:
+            letter = chr(65 + labels.index(choice))
             quiz_state["selected"] = letter
             quiz_state["answered"] = True
             
             # Update user progress
+            st.session_state.progress_dirty = True
             st.session_state.user_progress["questions_attempted"].add(q_id)
+            is_correct = letter == correct_answer
             
-            if letter == correct_answer:
+            if is_correct:
                 quiz_state["score"] += 1
                 st.session_state.user_progress["correct_questions"].add(q_id)
                 if q_id in st.session_state.user_progress["incorrect_questions"]:
@@ -365,19 +637,23 @@ def show_quiz():
                 if q_id in st.session_state.user_progress["correct_questions"]:
                     st.session_state.user_progress["correct_questions"].remove(q_id)
             
-            # Update performance by system
-            if system not in st.session_state.user_progress["performance_by_system"]:
-                st.session_state.user_progress["performance_by_system"][system] = {"correct": 0, "total": 0}
-            if subject not in st.session_state.user_progress["performance_by_subject"]:
-                st.session_state.user_progress["performance_by_subject"][subject] = {"correct": 0, "total": 0}
+            # Keep the candidate pools in step with the sets
+            q_pos = question_index["id_to_idx"].get(q_id)
+            if q_pos is not None:
+                candidate_pools = st.session_state.candidate_pools
+                candidate_pools["unused"][q_pos] = False
+                candidate_pools["incorrect"][q_pos] = not is_correct
             
-            # Update counts
-            st.session_state.user_progress["performance_by_system"][system]["total"] += 1
-            st.session_state.user_progress["performance_by_subject"][subject]["total"] += 1
+            # Update performance by system and subject
+            system_stats = st.session_state.user_progress["performance_by_system"][system]
+            subject_stats = st.session_state.user_progress["performance_by_subject"][subject]
+            system_stats["total"] += 1
+            system_stats["correct"] += is_correct
+            subject_stats["total"] += 1
+            subject_stats["correct"] += is_correct
             
-            if letter == correct_answer:
-                st.session_state.user_progress["performance_by_system"][system]["correct"] += 1
-                st.session_state.user_progress["performance_by_subject"][subject]["correct"] += 1
+            # Redraw so the form renders disabled with the recorded answer
+            st.rerun()
     
     # Explanation
     if quiz_state["answered"]:
@@ -417,7 +693,7 @@ def show_quiz():
     
     with col5:
         if st.button("End Quiz 🏁"):
-            if save_user_progress(st.session_state.username):
+            if save_user_progress(st.session_state.username, immediate=True):
                 st.success("Progress saved!")
             show_results(quiz_questions)
             return
@@ -468,14 +744,12 @@ def show_results(quiz_questions):
         st.warning("📚 More practice needed!")
     
     # Review marked questions
-    marked = quiz_state["marked"]
-    if marked:
+    marked_idx = np.flatnonzero(quiz_state["marked_mask"])
+    if marked_idx.size:
         st.subheader("📌 Questions Marked for Review")
-        for q_id in marked:
-            question = next((q for q in quiz_questions if q["id"] == q_id), None)
-            if question:
-                idx = quiz_questions.index(question) + 1
-                st.write(f"**Q{idx}:** {question['question'][:100]}...")
+        for idx in marked_idx:
+            question = quiz_questions[idx]
+            st.write(f"**Q{idx + 1}:** {question['question'][:100]}...")
     
     # Buttons
     col1, col2, col3 = st.columns(3)
@@ -486,7 +760,7 @@ def show_results(quiz_questions):
                 "score": 0,
                 "answered": False,
                 "selected": None,
-                "marked": set(),
+                "marked_mask": np.zeros(len(quiz_questions), dtype=bool),
                 "quiz_start_time": datetime.now()
             }
             st.rerun()
@@ -543,8 +817,7 @@ def show_performance_analysis():
                 })
         
         if system_data:
-            df = pd.DataFrame(system_data)
-            st.dataframe(df, hide_index=True, use_container_width=True)
+            st.dataframe(system_data, hide_index=True, use_container_width=True)
     else:
         st.info("No system performance data yet. Complete some quizzes!")
     
@@ -563,8 +836,7 @@ def show_performance_analysis():
                 })
         
         if subject_data:
-            df = pd.DataFrame(subject_data)
-            st.dataframe(df, hide_index=True, use_container_width=True)
+            st.dataframe(subject_data, hide_index=True, use_container_width=True)
     else:
         st.info("No subject performance data yet. Complete some quizzes!")
     
@@ -587,11 +859,17 @@ def show_auth():
             if not login_user or not login_pass:
                 st.error("Please enter both username and password")
             else:
-                success, message = authenticate_user(login_user, login_pass)
+                # One lookup serves both the password check and the progress load;
+                # after this the session works from st.session_state only
+                user = get_user(login_user)
+                success, message = authenticate_user(login_user, login_pass, user)
                 if success:
                     st.session_state.logged_in = True
                     st.session_state.username = login_user
-                    st.session_state.user_progress = load_user_progress(login_user)
+                    issue_session_token(login_user)
+                    st.session_state.user_progress = load_user_progress(login_user, user)
+                    st.session_state.candidate_pools = build_candidate_pools(st.session_state.user_progress)
+                    st.session_state.progress_dirty = False
                     st.success(f"Welcome back, {login_user}!")
                     st.rerun()
                 else:
@@ -619,6 +897,14 @@ def show_auth():
 
 # ---------------- MAIN APP FLOW ----------------
 def main():
+    if st.session_state.logged_in and not verify_session_token():
+        # Answers given before expiry still belong to this session; write them out
+        queue_user_progress(st.session_state.username, immediate=True)
+        st.session_state.logged_in = False
+        st.session_state.username = None
+        st.session_state.session_token = None
+        st.warning("Your session has expired. Please login again.")
+    
     # Sidebar
     with st.sidebar:
         st.title("📚 Navigation")
@@ -636,10 +922,11 @@ def main():
                 st.rerun()
             
             if st.button("🔓 Logout", use_container_width=True):
-                if save_user_progress(st.session_state.username):
+                if save_user_progress(st.session_state.username, immediate=True):
                     st.success("Progress saved!")
                 st.session_state.logged_in = False
                 st.session_state.username = None
+                st.session_state.session_token = None
                 st.session_state.show_analysis = False
                 st.rerun()
             
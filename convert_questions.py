@@ -0,0 +1,19 @@
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Converts questions.json to questions.parquet, which app.py memory-maps at
+# startup instead of parsing the JSON. Re-run whenever questions.json changes.
+
+def main():
+    with open("questions.json", "r", encoding="utf-8") as f:
+        questions = json.load(f)
+    
+    # Infer the schema from every row; from_pylist only looks at the first
+    # one and would drop fields that it lacks
+    table = pa.Table.from_batches([pa.RecordBatch.from_struct_array(pa.array(questions))])
+    pq.write_table(table, "questions.parquet")
+    print(f"Wrote {table.num_rows} questions to questions.parquet")
+
+if __name__ == "__main__":
+    main()